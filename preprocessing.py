@@ -9,8 +9,8 @@ with open('data.json', 'r') as f:
 
 script = data['text']
 
-# List to hold the categorized data
-processed_data = []
+# Column lists for the categorized data (one list per column instead of one dict per row)
+processed_data = {'Type': [], 'Content': [], 'Speaker': [], 'Dialogue': []}
 
 # Define categories to filter narrative context from dialogue
 CONTEXT_KEYS = ['LOCATION', 'ACTION', 'CHOICE']
@@ -25,20 +25,16 @@ for entry in script:
     
     if key in CONTEXT_KEYS:
         # It's a context entry
-        processed_data.append({
-            'Type': key,
-            'Content': value,
-            'Speaker': None,
-            'Dialogue': None
-        })
+        processed_data['Type'].append(key)
+        processed_data['Content'].append(value)
+        processed_data['Speaker'].append(None)
+        processed_data['Dialogue'].append(None)
     else:
         # It's a dialogue entry (Speaker is the key)
-        processed_data.append({
-            'Type': 'DIALOGUE',
-            'Content': None,
-            'Speaker': key,
-            'Dialogue': value
-        })
+        processed_data['Type'].append('DIALOGUE')
+        processed_data['Content'].append(None)
+        processed_data['Speaker'].append(key)
+        processed_data['Dialogue'].append(value)
 
 # Create the final structured DataFrame
 df_processed = pd.DataFrame(processed_data)
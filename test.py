@@ -1,30 +1,46 @@
 import json
 import pandas as pd
 from sentence_transformers import SentenceTransformer
-from transformers import pipeline, set_seed
+from transformers import AutoModelForCausalLM, AutoTokenizer, set_seed, BitsAndBytesConfig, StoppingCriteria, StoppingCriteriaList
+from transformers.utils import is_flash_attn_2_available
+import torch
 import chromadb
 import numpy as np
 import os 
-from huggingface_hub import login
+import re
+import hashlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from huggingface_hub import snapshot_download
 
 load_dotenv()
 hf_token = os.getenv("HUGGINGFACE_TOKEN")
 
 # --- 0. Configuration & Hugging Face Token Setup ---
 # NOTE: Using os.getenv to securely access your HF_TOKEN environment variable.
-os.environ["HF_TOKEN"] = hf_token
-try:
-    # Attempt to log in using the environment variable token
-    login(token=os.getenv("HF_TOKEN"), add_to_git_credential=False)
-except Exception:
-    # This block executes if the token is not found or login fails (harmless for public models)
-    pass 
+# huggingface_hub reads HF_TOKEN for every download, so no login() round-trip is needed at startup.
+if hf_token:
+    os.environ["HF_TOKEN"] = hf_token
 
 # Model names
 EMBEDDING_MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
 GENERATION_MODEL_NAME = "gpt2-medium"
 
+# Optional weight-only quantization of the generation model on CUDA: "4bit" (NF4), "8bit" or "none".
+# Requires the bitsandbytes and accelerate packages (device_map="auto"); ignored when running on CPU.
+GENERATION_QUANTIZATION = os.getenv("GENERATION_QUANTIZATION", "none").lower()
+
+# Set to "1" to run the generation model's forward pass through torch.compile (slow first call).
+GENERATION_TORCH_COMPILE = os.getenv("GENERATION_TORCH_COMPILE", "0") == "1"
+
+# Optional small draft model for assisted (speculative) decoding, e.g. "distilgpt2".
+# It must share the generation model's tokenizer; leave empty to disable.
+ASSISTANT_MODEL_NAME = os.getenv("ASSISTANT_MODEL_NAME", "")
+
+# Embedder weights: "auto" (fp16 on CUDA, fp32 on CPU), "fp16", "int8" (dynamic quantization, CPU only) or "fp32".
+EMBED_PRECISION = os.getenv("EMBED_PRECISION", "auto").lower()
+
 # ChromaDB Client Setup
 CHROMA_DB_PATH = "./chroma_db_ff7" 
 client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
@@ -51,7 +67,11 @@ with open('data.json', 'r') as f:
     data = json.load(f)
 
 script = data['text']
-dialogue_pairs = []
+# One list per column: pandas builds each column directly instead of inferring it from per-row dicts
+dialogue_pairs = {
+    'Location': [], 'Context_Action': [], 'Query_Speaker': [], 'Query_Text': [],
+    'Response_Speaker': [], 'Response_Text': []
+}
 last_dialogue_entry = None
 current_location = "Start"
 current_action = ""
@@ -81,31 +101,164 @@ for entry in script:
         if last_dialogue_entry:
             query_speaker, query_text = list(last_dialogue_entry.items())[0]
             
-            dialogue_pairs.append({
-                'Location': current_location,
-                'Context_Action': current_action,
-                'Query_Speaker': query_speaker,
-                'Query_Text': query_text,
-                'Response_Speaker': current_speaker,
-                'Response_Text': current_dialogue
-            })
+            dialogue_pairs['Location'].append(current_location)
+            dialogue_pairs['Context_Action'].append(current_action)
+            dialogue_pairs['Query_Speaker'].append(query_speaker)
+            dialogue_pairs['Query_Text'].append(query_text)
+            dialogue_pairs['Response_Speaker'].append(current_speaker)
+            dialogue_pairs['Response_Text'].append(current_dialogue)
         
         last_dialogue_entry = entry
         current_action = "" 
 
 df_contextual = pd.DataFrame(dialogue_pairs)
 
+# Lowercased names of every character who responds in the script (checked on each 'switch' command)
+KNOWN_SPEAKERS = set(df_contextual['Response_Speaker'].str.lower())
+
 # --- 2. Initialize Embedder and Generator Models ---
 
+def generation_model_kwargs() -> dict:
+    """Returns the from_pretrained kwargs for the generation model (dtype, attention backend, quantization)."""
+    # Stream weights straight into the model instead of materializing a randomly initialized copy first
+    model_kwargs = {"low_cpu_mem_usage": True}
+    
+    # Half precision wherever the hardware runs it natively: bf16 on Ampere+ GPUs (fp16 on older ones)
+    # and bf16 on CPUs with AVX512-BF16/AMX; other CPUs keep fp32, where bf16 would be emulated and slower
+    if torch.cuda.is_available():
+        # Capability check rather than is_bf16_supported(), which also reports True for emulated bf16 on T4/V100
+        model_kwargs["torch_dtype"] = torch.bfloat16 if torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+    elif getattr(torch.cpu, "_is_avx512_bf16_supported", lambda: False)():
+        model_kwargs["torch_dtype"] = torch.bfloat16
+    
+    # FlashAttention-2 needs an Ampere+ GPU and the flash-attn package; otherwise use PyTorch SDPA
+    if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8 and is_flash_attn_2_available():
+        model_kwargs["attn_implementation"] = "flash_attention_2"
+    else:
+        model_kwargs["attn_implementation"] = "sdpa"
+    
+    if not torch.cuda.is_available() or GENERATION_QUANTIZATION not in ("4bit", "8bit"):
+        return model_kwargs
+    
+    if GENERATION_QUANTIZATION == "4bit":
+        quantization_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=model_kwargs["torch_dtype"]
+        )
+    else:
+        quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+    
+    print(f"Quantizing generation weights to {GENERATION_QUANTIZATION}.")
+    model_kwargs.update(quantization_config=quantization_config, device_map="auto")
+    return model_kwargs
+
+# Matches the first sentence terminator so replies are trimmed (and generation stopped) in a single scan
+SENTENCE_END_RE = re.compile(r"[.?!\n]")
+
+class SentenceEndStoppingCriteria(StoppingCriteria):
+    """Stops generation once the continuation contains a sentence terminator after some text.
+    
+    Replies are cut at their first sentence anyway, so every token decoded past it is wasted work.
+    """
+    
+    def __init__(self, tokenizer, prompt_length: int):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+    
+    def __call__(self, input_ids, scores, **kwargs):
+        continuation = self.tokenizer.decode(input_ids[0, self.prompt_length:], skip_special_tokens=True)
+        is_done = SENTENCE_END_RE.search(continuation.lstrip()) is not None
+        return torch.full((input_ids.shape[0],), is_done, dtype=torch.bool, device=input_ids.device)
+
+class TextGenerator:
+    """Calls model.generate directly on tokenized prompts (no pipeline pre/post-processing per call)."""
+    
+    def __init__(self, model, tokenizer, assistant_model=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        # Over-long prompts lose their oldest tokens; the end holds the user turn and the NPC cue
+        self.tokenizer.truncation_side = "left"
+        self.assistant_model = assistant_model
+        self.context_length = getattr(model.config, "n_positions", None) or tokenizer.model_max_length
+    
+    def __call__(self, prompt: str, stop_at_sentence_end: bool = False, **generate_kwargs) -> str:
+        """Returns only the generated continuation (the prompt tokens are not decoded)."""
+        if self.assistant_model is not None:
+            generate_kwargs.setdefault("assistant_model", self.assistant_model)
+        
+        # Budget in tokens, leaving room in the context window for the reply itself
+        max_prompt_tokens = self.context_length - generate_kwargs.get("max_new_tokens", 0)
+        inputs = self.tokenizer(
+            prompt, return_tensors="pt", truncation=True, max_length=max_prompt_tokens
+        ).to(self.model.device)
+        prompt_length = inputs["input_ids"].shape[1]
+        if stop_at_sentence_end:
+            generate_kwargs["stopping_criteria"] = StoppingCriteriaList([
+                SentenceEndStoppingCriteria(self.tokenizer, prompt_length)
+            ])
+        
+        # inference_mode also skips the version-counter/view tracking that no_grad still does
+        with torch.inference_mode():
+            output_ids = self.model.generate(**inputs, **generate_kwargs)
+        return self.tokenizer.decode(output_ids[0, prompt_length:], skip_special_tokens=True)
+
+def load_embedder() -> SentenceTransformer:
+    """Loads the sentence embedder, reducing its weight precision according to EMBED_PRECISION."""
+    embedder = SentenceTransformer(EMBEDDING_MODEL_NAME)
+    
+    # At batch size 1 the MiniLM forward pass is bound by weight bandwidth, so smaller weights embed faster
+    if torch.cuda.is_available() and EMBED_PRECISION in ("auto", "fp16"):
+        embedder = embedder.half()
+        print("Embedding Model running in float16.")
+    elif not torch.cuda.is_available() and EMBED_PRECISION == "int8":
+        transformer = embedder[0]
+        transformer.auto_model = torch.ao.quantization.quantize_dynamic(
+            transformer.auto_model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+        print("Embedding Model Linear layers quantized to int8.")
+    return embedder
+
+def load_generator() -> TextGenerator:
+    """Loads the generation model, tokenizer and optional draft model."""
+    model_kwargs = generation_model_kwargs()
+    generation_tokenizer = AutoTokenizer.from_pretrained(GENERATION_MODEL_NAME)
+    generation_model = AutoModelForCausalLM.from_pretrained(GENERATION_MODEL_NAME, **model_kwargs)
+    if "device_map" not in model_kwargs and torch.cuda.is_available():
+        generation_model.to("cuda")
+    
+    if GENERATION_TORCH_COMPILE:
+        # generate() stays in Python; compiling forward() covers the per-token decode step.
+        # dynamic=True traces the prompt length symbolically, so each new prompt length does not recompile.
+        generation_model.forward = torch.compile(generation_model.forward, mode="reduce-overhead", fullgraph=False, dynamic=True)
+        # A static (pre-allocated) KV cache keeps tensor shapes fixed so the compiled graph is not re-traced per token
+        if getattr(generation_model, "_supports_static_cache", False) or getattr(generation_model, "_can_compile_fullgraph", False):
+            generation_model.generation_config.cache_implementation = "static"
+        print("Generation model forward pass wrapped with torch.compile.")
+    
+    assistant_model = None
+    if ASSISTANT_MODEL_NAME:
+        print(f"Loading Assistant (Draft) Model: {ASSISTANT_MODEL_NAME}...")
+        assistant_model = AutoModelForCausalLM.from_pretrained(
+            ASSISTANT_MODEL_NAME, torch_dtype=generation_model.dtype, low_cpu_mem_usage=True
+        ).to(generation_model.device)
+    
+    return TextGenerator(generation_model, generation_tokenizer, assistant_model)
+
+def prefetch_generation_files():
+    """Downloads the generation (and draft) model files into the Hugging Face cache without building a model."""
+    for repo_id in filter(None, (GENERATION_MODEL_NAME, ASSISTANT_MODEL_NAME)):
+        # Only what from_pretrained reads: configs, tokenizer files and the safetensors weights
+        snapshot_download(repo_id, allow_patterns=["*.json", "*.txt", "*.safetensors"])
+
+# from_pretrained temporarily changes process-wide torch state (default dtype, parameter init hooks), so both
+# models are built on this thread; only the generation model's download overlaps the embedder load and ChromaDB setup.
+model_loader = ThreadPoolExecutor(max_workers=1)
+generation_download = model_loader.submit(prefetch_generation_files)
 print(f"Loading Embedding Model: {EMBEDDING_MODEL_NAME}...")
-embedder = SentenceTransformer(EMBEDDING_MODEL_NAME)
+embedder = load_embedder()
 print("Embedding Model Loaded.")
 
-print(f"Loading Generation Model: {GENERATION_MODEL_NAME}...")
-generator = pipeline('text-generation', model=GENERATION_MODEL_NAME, max_new_tokens=60, truncation=True)
-set_seed(42) 
-print("Generation Model Loaded.")
-
 # --- 3. Setup ChromaDB and Add Data (CRITICAL FIX) ---
 
 def initialize_chroma_db(df: pd.DataFrame, embedder: SentenceTransformer, client: chromadb.Client):
@@ -121,72 +274,176 @@ def initialize_chroma_db(df: pd.DataFrame, embedder: SentenceTransformer, client
         'Response_Text': 'response_text'
     })
 
+    metadata_columns = [
+        'location', 'context_action', 'query_speaker', 'query_text', 
+        'response_speaker', 'response_text'
+    ]
+    # Fingerprint of everything that ends up in the collection; a row count alone misses edited lines
+    corpus_hash = hashlib.blake2b(
+        EMBEDDING_MODEL_NAME.encode() + pd.util.hash_pandas_object(df_for_metadata[metadata_columns], index=False).values.tobytes(),
+        digest_size=16
+    ).hexdigest()
+
     try:
         collection = client.get_or_create_collection(name=COLLECTION_NAME)
         print(f"ChromaDB collection '{COLLECTION_NAME}' accessed.")
         
-        if collection.count() == 0 or collection.count() != len(df):
+        # The count check also catches a collection whose last rebuild never completed
+        is_current = (
+            (collection.metadata or {}).get("corpus_hash") == corpus_hash
+            and collection.count() == len(df_for_metadata)
+        )
+        if not is_current:
             print(f"Collection '{COLLECTION_NAME}' is empty or outdated. Re-indexing...")
+            # add() skips ids that already exist, so an outdated collection is rebuilt rather than appended to
+            client.delete_collection(name=COLLECTION_NAME)
+            collection = client.create_collection(name=COLLECTION_NAME)
             
             print("Generating embeddings for dialogue queries...")
-            query_embeddings = embedder.encode(df_for_metadata['query_text'].tolist(), show_progress_bar=True)
+            # Short lines ("...", "Yeah.") recur throughout the script: encode each distinct text once,
+            # then expand back to one row per pair
+            text_codes, unique_texts = pd.factorize(df_for_metadata['query_text'])
+            # Unit-length float32 rows, matching what DialogueIndex searches with a plain dot product
+            query_embeddings = embedder.encode(
+                unique_texts.tolist(),
+                batch_size=128,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=True
+            ).astype(np.float32)[text_codes]
             
-            metadatas = df_for_metadata[[
-                'location', 'context_action', 'query_speaker', 'query_text', 
-                'response_speaker', 'response_text'
-            ]].to_dict(orient='records')
+            metadatas = df_for_metadata[metadata_columns].to_dict(orient='records')
             
             ids = [f"pair_{i}" for i in range(len(df_for_metadata))]
             
             collection.add(
-                embeddings=query_embeddings.tolist(), 
+                embeddings=query_embeddings, 
                 documents=df_for_metadata['query_text'].tolist(), 
                 metadatas=metadatas,
                 ids=ids
             )
-            print(f"Successfully added {collection.count()} entries to ChromaDB.")
+            # Stamp the fingerprint last, so an interrupted or failed rebuild is retried on the next start
+            collection.modify(metadata={"corpus_hash": corpus_hash})
+            print(f"Successfully added {len(ids)} entries to ChromaDB.")
         else:
-            print(f"ChromaDB collection '{COLLECTION_NAME}' already contains {collection.count()} entries. Skipping re-indexing.")
+            print(f"ChromaDB collection '{COLLECTION_NAME}' is up to date ({len(df_for_metadata)} entries). Skipping re-indexing.")
             
     except Exception as e:
         print(f"Error initializing ChromaDB: {e}")
     
     return client.get_collection(name=COLLECTION_NAME)
 
-# Initialize or load the ChromaDB collection
+class DialogueIndex:
+    """In-memory copy of the ChromaDB collection, searched exactly with one matrix-vector product.
+    
+    The corpus is a few thousand 384-d vectors (a few MB), so a brute-force search over one
+    contiguous float32 matrix is cheaper than a round-trip through Chroma's HNSW/SQLite layers.
+    """
+    
+    def __init__(self, collection):
+        records = collection.get(include=['embeddings', 'metadatas', 'documents'])
+        embeddings = np.asarray(records['embeddings'], dtype=np.float32)
+        # Unit-length rows: inner product == cosine similarity (same ranking as Chroma's L2 on these embeddings).
+        # An empty collection comes back as a 1-D empty array; it is kept as is and query() returns no rows.
+        if len(embeddings):
+            embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+        self.embeddings = embeddings
+        self.documents = records['documents']
+        self.metadatas = records['metadatas']
+        # Lowercased responder per row (the metadata uses the known lowercase key, see initialize_chroma_db)
+        self.response_speakers = np.array([metadata.get('response_speaker', '').lower() for metadata in self.metadatas])
+    
+    def query(self, query_embedding: np.ndarray, n_results: int) -> np.ndarray:
+        """Returns the row indices of the n_results most similar entries, best match first."""
+        n_results = min(n_results, len(self.embeddings))
+        if n_results == 0:
+            return np.empty(0, dtype=np.int64)
+        
+        scores = self.embeddings @ query_embedding
+        top = np.argpartition(-scores, n_results - 1)[:n_results]
+        return top[np.argsort(-scores[top])]
+
+# Initialize or load the ChromaDB collection, then keep its vectors in memory for querying
 chroma_collection = initialize_chroma_db(df_contextual, embedder, client)
+dialogue_index = DialogueIndex(chroma_collection)
+print(f"Loaded {len(dialogue_index.documents)} dialogue embeddings into the in-memory index.")
+
+def warm_up_models(embedder: SentenceTransformer, generator: TextGenerator):
+    """Runs a tiny encode and generate (and a longer prompt when compiling) so the first real turn doesn't pay one-off kernel/compile costs."""
+    warm_up_prompts = ["Hello there."]
+    if GENERATION_TORCH_COMPILE:
+        # A second, RAG-sized prompt length makes the compiled forward cover more than the 3-token shape
+        warm_up_prompts.append(" ".join(["Hello there."] * 64))
+    try:
+        embedder.encode("Hello there.", normalize_embeddings=True)
+        for prompt in warm_up_prompts:
+            generator(prompt, do_sample=False, max_new_tokens=4, pad_token_id=generator.tokenizer.eos_token_id)
+    except Exception as e:
+        print(f"Model warm-up skipped: {e}")
+
+# The generation model's files have been downloading in the background since section 2
+try:
+    generation_download.result()
+except Exception as e:
+    # from_pretrained retries the download (or uses the local cache) itself
+    print(f"Background download of the generation model failed: {e}")
+model_loader.shutdown()
+print(f"Loading Generation Model: {GENERATION_MODEL_NAME}...")
+generator = load_generator()
+warm_up_models(embedder, generator)
+set_seed(42) 
+print("Generation Model Loaded.")
 
 # --- 4. RAG Chatbot Function (Improved Filtering, Fallback, and Generation) ---
 
-def rag_chatbot_response(user_query: str, target_npc: str, conversation_history: list, chroma_collection, embedder, generator) -> str:
-    """Generates a conversational response for a target NPC using RAG."""
+# Cache of retrieval results keyed by (normalized query, NPC). The embedding model is
+# uncased, so case/whitespace variants of a question map to the same entry.
+RETRIEVAL_CACHE_SIZE = 256
+_retrieval_cache = OrderedDict()
+
+def retrieve_npc_examples(user_query: str, target_npc: str, dialogue_index: DialogueIndex, embedder) -> list:
+    """Returns up to 4 past interactions where the target NPC answered a similar query."""
     
-    # 1. Embed the user query
-    user_query_embedding = embedder.encode([user_query]).tolist()
+    cache_key = (user_query.strip().lower(), target_npc.lower())
+    if cache_key in _retrieval_cache:
+        _retrieval_cache.move_to_end(cache_key)
+        return _retrieval_cache[cache_key]
     
-    # 2. Retrieve top K similar dialogue entries from ChromaDB
+    # 1. Embed the user query (unit length, to match the index rows)
+    user_query_embedding = embedder.encode(user_query, normalize_embeddings=True)
+    
+    # 2. Retrieve top K similar dialogue entries from the in-memory index
     # Retrieve more results to increase the chance of finding the target NPC
-    retrieved_results = chroma_collection.query(
-        query_embeddings=user_query_embedding,
-        n_results=15, 
-        include=['metadatas', 'documents'] 
-    )
+    top_indices = dialogue_index.query(user_query_embedding, n_results=15)
 
-    # 3. Filter retrieved results for the target NPC
+    # 3. Filter retrieved results for the target NPC (one vectorized mask, keeping rank order)
+    speaker_mask = dialogue_index.response_speakers[top_indices] == target_npc.lower()
     filtered_results = []
-    for i in range(len(retrieved_results['documents'][0])):
-        metadata = retrieved_results['metadatas'][0][i]
-        
-        # Accessing the metadata using the known lowercase key (The Fix)
-        if metadata.get('response_speaker', '').lower() == target_npc.lower(): 
-            filtered_results.append({
-                'query_text': retrieved_results['documents'][0][i],
-                'response_text': metadata.get('response_text'),
-                'context': metadata.get('location', '') + " | " + metadata.get('context_action', ''),
-                'response_speaker': metadata.get('response_speaker')
-            })
-            if len(filtered_results) >= 4: # Get up to 4 relevant matches now
-                break
+    for i in top_indices[speaker_mask][:4]: # Get up to 4 relevant matches now
+        metadata = dialogue_index.metadatas[i]
+        filtered_results.append({
+            'query_text': dialogue_index.documents[i],
+            'response_text': metadata.get('response_text'),
+            'context': metadata.get('location', '') + " | " + metadata.get('context_action', ''),
+            'response_speaker': metadata.get('response_speaker')
+        })
+    
+    _retrieval_cache[cache_key] = filtered_results
+    if len(_retrieval_cache) > RETRIEVAL_CACHE_SIZE:
+        _retrieval_cache.popitem(last=False)
+    
+    return filtered_results
+
+def trim_to_first_sentence(text: str) -> str:
+    """Cuts the text right after its first sentence terminator ('.', '?', '!' or newline)."""
+    match = SENTENCE_END_RE.search(text)
+    return text[:match.end()] if match else text
+
+def rag_chatbot_response(user_query: str, target_npc: str, conversation_history: deque, dialogue_index: DialogueIndex, embedder, generator) -> str:
+    """Generates a conversational response for a target NPC using RAG."""
+    
+    # 1-3. Embed, retrieve and filter past dialogue for the target NPC (cached)
+    filtered_results = retrieve_npc_examples(user_query, target_npc, dialogue_index, embedder)
     
     # --- FALLBACK GENERATION (The key to fixing the repetition) ---
     if not filtered_results:
@@ -202,72 +459,59 @@ def rag_chatbot_response(user_query: str, target_npc: str, conversation_history:
         # Generate with a slightly higher temperature for more character flavor
         fallback_output = generator(
             fallback_prompt, 
-            num_return_sequences=1, 
             do_sample=True, 
             temperature=0.8,
             top_k=50, top_p=0.95,
             pad_token_id=generator.tokenizer.eos_token_id, 
-            max_new_tokens=30 # Keep it short to avoid excessive gibberish
-        )[0]['generated_text']
+            max_new_tokens=30, # Keep it short to avoid excessive gibberish
+            stop_at_sentence_end=True # Only the first sentence is kept below
+        )
 
-        # Extracting the response
-        if f"{target_npc}:" in fallback_output:
-            response = fallback_output.split(f"{target_npc}:")[-1].strip()
-            
-            # Clean up and ensure a sentence end
-            sentence_endings = ['.', '?', '!', '\n']
-            for ending in sentence_endings:
-                if ending in response:
-                    response = response.split(ending)[0] + ending
-                    break
-            # If still no sentence end, use a generic clean-up
-            if not any(e in response for e in ['.', '?', '!']):
-                response = response.split('\n')[0].strip() + "."
-                
-            return response.replace(f"{target_npc}:", "").strip()
+        # Extracting the response (if the model wrote another "NPC:" label, keep what follows it)
+        response = fallback_output.rpartition(f"{target_npc}:")[2].strip()
+        if not response:
+            return "I'm focusing on the mission right now. Come back later."
         
-        return "I'm focusing on the mission right now. Come back later."
+        # Clean up and ensure a sentence end (rpartition already removed every "NPC:" label)
+        response = trim_to_first_sentence(response)
+        # If still no sentence end (cut at a newline or no terminator at all), close it with a period
+        if not response.endswith(('.', '?', '!')):
+            response = response.rstrip() + "."
+            
+        return response
 
 
-    # 4. Construct the RAG prompt 
-    prompt = ""
-    for entry in conversation_history[-2:]: 
-        prompt += f"{entry['speaker']}: {entry['text']}\n"
+    # 4. Construct the RAG prompt (collect the parts and join once)
+    prompt_parts = [f"{entry['speaker']}: {entry['text']}\n" for entry in list(conversation_history)[-2:]]
     
-    prompt += f"User: {user_query}\n"
-    prompt += f"Context for {target_npc}'s response (based on past dialogue):\n"
-    for i, res in enumerate(filtered_results):
-        prompt += f"  - Similar past interaction (query): '{res['query_text']}'\n"
-        prompt += f"  - {target_npc}'s past response: '{res['response_text']}'\n"
+    prompt_parts.append(f"User: {user_query}\n")
+    prompt_parts.append(f"Context for {target_npc}'s response (based on past dialogue):\n")
+    for res in filtered_results:
+        prompt_parts.append(f"  - Similar past interaction (query): '{res['query_text']}'\n")
+        prompt_parts.append(f"  - {target_npc}'s past response: '{res['response_text']}'\n")
     
-    prompt += f"\n{target_npc}:" 
+    prompt_parts.append(f"\n{target_npc}:")
+    prompt = "".join(prompt_parts)
     
     # 5. Generate the RAG-based response
     # Using top_k and top_p for better coherence
     generated_output = generator(
         prompt, 
-        num_return_sequences=1, 
         do_sample=True, 
         temperature=0.7,
         top_k=50, top_p=0.95,
         pad_token_id=generator.tokenizer.eos_token_id, 
-        max_new_tokens=60 
-    )[0]['generated_text']
+        max_new_tokens=60,
+        stop_at_sentence_end=True # Only the first sentence is kept below
+    )
 
     # 6. Extract only the NPC's actual response
-    if f"\n{target_npc}:" in generated_output:
-        response_text = generated_output.split(f"\n{target_npc}:")[-1].strip()
-        
-        # Clean up and ensure a sentence end
-        sentence_endings = ['.', '?', '!', '\n']
-        for ending in sentence_endings:
-            if ending in response_text:
-                response_text = response_text.split(ending)[0] + ending
-                break
-        
-        return response_text
-    else:
+    response_text = generated_output.rpartition(f"\n{target_npc}:")[2].strip()
+    if not response_text:
         return "I'm trying to figure out what you mean. Ask me something more specific."
+    
+    # Clean up and ensure a sentence end
+    return trim_to_first_sentence(response_text)
 
 
 # --- 5. Interactive Chat Loop (Example) ---
@@ -278,7 +522,8 @@ if __name__ == "__main__":
     print("Type 'exit' to quit. Type 'switch NPC_NAME' to change who you're talking to.")
 
     current_npc = "Cloud" # Default NPC
-    conversation_history = [] 
+    # Keep history to a manageable size (last 4 turns); the deque evicts the oldest entry on append
+    conversation_history = deque(maxlen=4)
 
     while True:
         try:
@@ -289,13 +534,13 @@ if __name__ == "__main__":
             if user_input.lower().startswith('switch '):
                 new_npc = user_input.split(' ', 1)[1].strip()
                 # Simple check if the NPC exists in our Response_Speaker list
-                if new_npc.lower() in df_contextual['Response_Speaker'].str.lower().unique():
+                if new_npc.lower() in KNOWN_SPEAKERS:
                     current_npc = new_npc
-                    conversation_history = [] 
+                    conversation_history.clear()
                     print(f"--- Now chatting with {current_npc}. ---")
                 elif new_npc.lower() in CHARACTER_PROFILES:
                     current_npc = new_npc.capitalize()
-                    conversation_history = [] 
+                    conversation_history.clear()
                     print(f"--- Now chatting with {current_npc}. ---")
                 else:
                     print(f"NPC '{new_npc}' not found in the script. Please try a core character like Cloud or Tifa.")
@@ -305,17 +550,13 @@ if __name__ == "__main__":
             conversation_history.append({"speaker": "User", "text": user_input})
 
             # Generate NPC response
-            npc_response = rag_chatbot_response(user_input, current_npc, conversation_history, chroma_collection, embedder, generator)
+            npc_response = rag_chatbot_response(user_input, current_npc, conversation_history, dialogue_index, embedder, generator)
             print(f"{current_npc}: {npc_response}")
             
             # Add NPC's response to history
             conversation_history.append({"speaker": current_npc, "text": npc_response})
-            
-            # Keep history to a manageable size (e.g., last 4 turns)
-            if len(conversation_history) > 4:
-                conversation_history = conversation_history[-4:]
                 
         except Exception as e:
             print(f"\n[ERROR] An unexpected error occurred: {e}. Resetting chat history.")
-            conversation_history = []
+            conversation_history.clear()
             continue
\ No newline at end of file